@@ -3,41 +3,133 @@ Lambda Function Handler for Serverless API Backend
 
 This Lambda function provides two main functionalities:
 1. Extracts and returns visitor location information from CloudFront headers
-2. Queries CloudWatch Logs to retrieve WAF blocked request counts
+2. Retrieves WAF blocked request counts from CloudWatch
 
 Environment Variables:
-    WAF_LOG_GROUP_NAME: Name of the CloudWatch Log Group containing WAF logs
+    WAF_WEB_ACL_METRIC_NAME: Metric name (visibility_config.metric_name) of the
+        WAF Web ACL whose BlockedRequests metric is read
+    WAF_LOG_GROUP_NAME: Name of the CloudWatch Log Group containing WAF logs,
+        queried with Logs Insights when WAF_WEB_ACL_METRIC_NAME is not set
+    WAF_CACHE_TTL: Seconds to reuse a WAF block count in a warm container (default: 60)
+    LOG_LEVEL: Logging level name, e.g. DEBUG, INFO, WARNING. When unset, the
+        level configured by Lambda (AWS_LAMBDA_LOG_LEVEL) is left in place
+    LAMBDA_DEBUG: Set to "1" to force DEBUG level and log full events,
+        headers and query responses
 """
 
+import functools
 import json
+import logging
 import os
+import random
 import time
-from datetime import datetime, timedelta
-from typing import Dict, Any, Optional
+from typing import Callable, Dict, Any, Final, FrozenSet, List, Optional
 
 import boto3
+from botocore.config import Config
+
+# Log through the root logger so Lambda's log format settings (including
+# AWS_LAMBDA_LOG_FORMAT=JSON) apply. Messages use %-style arguments so they
+# are only formatted when the level is enabled.
+# The level is only overridden when explicitly requested, so Lambda's own
+# log-level control keeps working otherwise.
+logger = logging.getLogger()
+LOG_LEVEL: str = os.environ.get("LOG_LEVEL", "").upper()
+
+if os.environ.get("LAMBDA_DEBUG") == "1":
+    logger.setLevel(logging.DEBUG)
+elif LOG_LEVEL:
+    # An unknown level name must not break every invocation at import time
+    if isinstance(logging.getLevelName(LOG_LEVEL), int):
+        logger.setLevel(LOG_LEVEL)
+    else:
+        logger.setLevel(logging.INFO)
+        logger.warning("Unknown LOG_LEVEL %r, using INFO", LOG_LEVEL)
+
+# Verbose logging of events, headers and query responses is opt-in, since
+# building those dumps is costly and inflates CloudWatch Logs ingestion.
+DEBUG: bool = logger.isEnabledFor(logging.DEBUG)
+
+# Tight timeouts and few retries so a degraded CloudWatch endpoint fails fast
+# instead of holding the Lambda; keep-alive lets warm containers reuse sockets.
+BOTO_CONFIG: Config = Config(
+    connect_timeout=2,
+    read_timeout=5,
+    retries={"max_attempts": 2, "mode": "adaptive"},
+    tcp_keepalive=True,
+)
+
+# Get the WAF Web ACL metric name and log group name from environment variables.
+# WAF publishes its metrics under the ACL's metric name, not the ACL name.
+WAF_WEB_ACL_METRIC_NAME: str = os.environ.get("WAF_WEB_ACL_METRIC_NAME", "")
+WAF_LOG_GROUP_NAME: str = os.environ.get("WAF_LOG_GROUP_NAME", "")
+
+# How long (in seconds) a WAF block count is served from memory before
+# reading CloudWatch again. Warm Lambda containers keep module
+# state between invocations, so frequent dashboard refreshes hit this cache.
+WAF_CACHE_TTL: int = int(os.environ.get("WAF_CACHE_TTL", "60"))
+
+# Standard CORS headers included in all responses. Built once at import and
+# shared by every response; it must stay a plain dict because the Lambda
+# runtime serializes the returned response with json.
+CORS_HEADERS: Dict[str, str] = {
+    "Content-Type": "application/json",
+    "Access-Control-Allow-Origin": "*",
+    "Access-Control-Allow-Headers": "Content-Type,X-Amz-Date,Authorization,X-Api-Key,X-Amz-Security-Token",
+    "Access-Control-Allow-Methods": "GET,OPTIONS",
+}
+
+# Response bodies that never change, serialized once at import
+_ZERO_BODY: Final[str] = json.dumps({"blockCount": 0})
+_NOT_CONFIGURED_BODY: Final[str] = json.dumps(
+    {"error": "WAF web ACL metric name or log group name not configured."}
+)
+_BAD_ACTION_BODY: Final[str] = json.dumps(
+    {
+        "error": "Missing or invalid action parameter.",
+        "validActions": ["location", "waf"],
+    }
+)
 
-# WAF logs for CloudFront are always in us-east-1.
-# We must explicitly create the client in that region.
-logs_client = boto3.client("logs", region_name="us-east-1")
+# CloudWatch Logs Insights query to count blocked requests. Only the field
+# needed for filtering is referenced, so no extra fields are materialized.
+WAF_QUERY: str = "filter action = 'BLOCK' | stats count(*) as blockCount"
 
-# Get the WAF log group name from environment variables
-WAF_LOG_GROUP_NAME: str = os.environ.get("WAF_LOG_GROUP_NAME", "")
+# lastEventTimestamp on log streams is only eventually consistent and can lag
+# ingestion by up to an hour, so a log group only counts as quiet once its
+# latest event is this many seconds older than the start of the query window.
+LAST_EVENT_LAG: int = 3600
+
+# Logs Insights query statuses after which polling stops
+QUERY_TERMINAL_STATUSES: FrozenSet[str] = frozenset(
+    {"Complete", "Failed", "Cancelled", "Timeout", "Unknown"}
+)
 
+# Serialized body of the last successful WAF block count and the monotonic
+# time it expires at
+_WAF_CACHE: Dict[str, Any] = {"expires": 0.0, "body": _ZERO_BODY}
 
-def get_cors_headers() -> Dict[str, str]:
+
+@functools.lru_cache(maxsize=None)
+def _logs_client() -> Any:
     """
-    Returns standard CORS headers to be included in all responses.
+    Returns the CloudWatch Logs client, creating it on first use.
 
-    Returns:
-        Dictionary of CORS headers
+    WAF logs for CloudFront are always in us-east-1, so the client is
+    explicitly created in that region. Creating it lazily keeps it out of
+    cold starts that only serve location requests.
     """
-    return {
-        "Content-Type": "application/json",
-        "Access-Control-Allow-Origin": "*",
-        "Access-Control-Allow-Headers": "Content-Type,X-Amz-Date,Authorization,X-Api-Key,X-Amz-Security-Token",
-        "Access-Control-Allow-Methods": "GET,OPTIONS",
-    }
+    return boto3.client("logs", region_name="us-east-1", config=BOTO_CONFIG)
+
+
+@functools.lru_cache(maxsize=None)
+def _cloudwatch_client() -> Any:
+    """
+    Returns the CloudWatch client, creating it on first use.
+
+    WAF metrics for CloudFront are always published in us-east-1.
+    """
+    return boto3.client("cloudwatch", region_name="us-east-1", config=BOTO_CONFIG)
 
 
 def get_visitor_location(event: Dict[str, Any]) -> Dict[str, Any]:
@@ -55,15 +147,14 @@ def get_visitor_location(event: Dict[str, Any]) -> Dict[str, Any]:
         - city: Viewer's city
         - region: Viewer's region, state, or province (e.g., ON, CA, NY)
         - country: Viewer's country code
-        - edgeLocation: CloudFront edge location identifier from X-Amz-Cf-Id
+        - edgeLocation: CloudFront edge location identifier from X-Amz-Cf-Pop
     """
     headers: Dict[str, Any] = event.get("headers", {})
 
-    # DEBUG LOGGING: Print all headers received
-    print("=" * 80)
-    print("DEBUG: All headers received by Lambda:")
-    print(json.dumps(headers, indent=2))
-    print("=" * 80)
+    if DEBUG:
+        logger.debug(
+            "All headers received by Lambda: %s", json.dumps(headers, indent=2)
+        )
 
     # Helper function to extract header value (case-insensitive)
     # API Gateway may format headers as arrays, so handle both cases
@@ -92,23 +183,22 @@ def get_visitor_location(event: Dict[str, Any]) -> Dict[str, Any]:
     region: str = get_header_value(headers, "cloudfront-viewer-country-region")
     # Country code (e.g., CA, US)
     country: str = get_header_value(headers, "cloudfront-viewer-country")
-    # Edge location identifier - extracted from X-Amz-Cf-Id header
-    # This contains the POP (Point of Presence) code in the format: XXXXX-YYYYY
-    cf_id: str = get_header_value(headers, "x-amz-cf-id")
-    edge_location: str = cf_id.split("-")[0] if cf_id != "Unknown" else "Unknown"
-
-    # DEBUG LOGGING: Print extracted values
-    print("DEBUG: Extracted location values:")
-    print(f"  City: {city}")
-    print(f"  Region: {region}")
-    print(f"  Country: {country}")
-    print(f"  CF-ID (full): {cf_id}")
-    print(f"  Edge Location (POP): {edge_location}")
-    print("=" * 80)
+    # Edge location identifier - the POP (Point of Presence) that served
+    # the request, e.g. YTO50-C1
+    edge_location: str = get_header_value(headers, "x-amz-cf-pop")
+
+    logger.debug(
+        "Extracted location values: city=%s, region=%s, country=%s, "
+        "edge_location=%s",
+        city,
+        region,
+        country,
+        edge_location,
+    )
 
     return {
         "statusCode": 200,
-        "headers": get_cors_headers(),
+        "headers": CORS_HEADERS,
         "body": json.dumps(
             {
                 "city": city,
@@ -120,118 +210,288 @@ def get_visitor_location(event: Dict[str, Any]) -> Dict[str, Any]:
     }
 
 
-def get_waf_block_count(event: Dict[str, Any]) -> Dict[str, Any]:
+def _await_query(query_id: str, max_wait: float = 10.0) -> Dict[str, Any]:
     """
-    Queries CloudWatch Logs to count blocked requests by WAF in the last hour.
+    Polls a CloudWatch Logs Insights query until it reaches a terminal status.
 
-    Uses CloudWatch Logs Insights to query WAF logs and count how many
-    requests were blocked in the past 60 minutes.
+    Polling uses exponential backoff with jitter, starting small so fast
+    queries return quickly, and gives up after max_wait seconds so a stuck
+    query cannot hold the Lambda until its own timeout. A query that times
+    out is stopped before the error is raised.
 
     Args:
-        event: The Lambda event object (unused but required for handler compatibility)
+        query_id: ID returned by start_query
+        max_wait: Maximum number of seconds to wait for the query
 
     Returns:
-        A dictionary containing the HTTP response with block count data
+        The final get_query_results response
 
     Raises:
-        Returns 500 status code if WAF log group is not configured or query fails
+        TimeoutError: If the query has not finished within max_wait seconds
     """
-    # DEBUG LOGGING: Check WAF configuration
-    print("=" * 80)
-    print(f"DEBUG: WAF_LOG_GROUP_NAME = {WAF_LOG_GROUP_NAME}")
-    print("=" * 80)
-
-    # Validate WAF log group configuration
-    if not WAF_LOG_GROUP_NAME:
-        print("ERROR: WAF log group name not configured!")
-        return {
-            "statusCode": 500,
-            "headers": get_cors_headers(),
-            "body": json.dumps({"error": "WAF log group name not configured."}),
-        }
+    start: float = time.monotonic()
+    delay: float = 0.1
+    poll_count: int = 0
+
+    while True:
+        time.sleep(delay + random.uniform(0, delay * 0.1))
+        delay = min(delay * 1.7, 2.0)
+        poll_count += 1
+
+        response: Dict[str, Any] = _logs_client().get_query_results(queryId=query_id)
+        status: str = response["status"]
+        logger.debug("Poll #%d - Query status: %s", poll_count, status)
+
+        if status in QUERY_TERMINAL_STATUSES:
+            return response
+
+        if time.monotonic() - start > max_wait:
+            # Stop the abandoned query so retries on later refreshes do not
+            # pile up against the concurrent Insights query limit
+            try:
+                _logs_client().stop_query(queryId=query_id)
+            except Exception as e:
+                logger.error("Failed to stop query %s: %s", query_id, e)
+            raise TimeoutError(
+                f"Query {query_id} did not complete within {max_wait} seconds"
+            )
 
-    # Define time range for query (last hour)
-    end_time: datetime = datetime.utcnow()
-    start_time: datetime = end_time - timedelta(hours=1)
-
-    # CloudWatch Logs Insights query to count blocked requests
-    query: str = """
-    fields @timestamp, httpRequest.clientIp, action
-    | filter action = 'BLOCK'
-    | stats count(*) as blockCount
+
+def _get_blocked_requests_metric(start_ts: int, end_ts: int) -> int:
     """
+    Sums the WAF BlockedRequests metric for the Web ACL over a time range.
 
-    print(f"DEBUG: Starting WAF query from {start_time} to {end_time}")
+    WAF publishes this metric to CloudWatch on its own, so a single
+    GetMetricData call replaces a Logs Insights query and its polling.
+    The WebACL dimension is the ACL's metric name, CloudFront-scoped Web
+    ACLs report without a Region dimension, and the "ALL" rule aggregates
+    blocks across every rule in the ACL.
 
-    try:
-        # Start the CloudWatch Logs Insights query
-        start_query_response: Dict[str, Any] = logs_client.start_query(
-            logGroupName=WAF_LOG_GROUP_NAME,
-            startTime=int(start_time.timestamp()),
-            endTime=int(end_time.timestamp()),
-            queryString=query,
+    Args:
+        start_ts: Start of the time range (epoch seconds)
+        end_ts: End of the time range (epoch seconds)
+
+    Returns:
+        Total number of blocked requests in the time range
+    """
+    response: Dict[str, Any] = _cloudwatch_client().get_metric_data(
+        MetricDataQueries=[
+            {
+                "Id": "blocks",
+                "MetricStat": {
+                    "Metric": {
+                        "Namespace": "AWS/WAFV2",
+                        "MetricName": "BlockedRequests",
+                        "Dimensions": [
+                            {"Name": "WebACL", "Value": WAF_WEB_ACL_METRIC_NAME},
+                            {"Name": "Rule", "Value": "ALL"},
+                        ],
+                    },
+                    "Period": 3600,
+                    "Stat": "Sum",
+                },
+            }
+        ],
+        StartTime=start_ts,
+        EndTime=end_ts,
+    )
+
+    if DEBUG:
+        logger.debug(
+            "Metric data response: %s", json.dumps(response, indent=2, default=str)
+        )
+
+    # The window may straddle two periods, so add up every datapoint.
+    # No datapoints usually means nothing was blocked, but it is also what a
+    # wrong WebACL dimension looks like, so make it visible in the logs.
+    values: List[float] = response["MetricDataResults"][0]["Values"]
+    if not values:
+        logger.warning(
+            "No BlockedRequests datapoints for WebACL=%s; reporting 0 "
+            "(check WAF_WEB_ACL_METRIC_NAME if blocks are expected)",
+            WAF_WEB_ACL_METRIC_NAME,
         )
+    return int(sum(values))
+
+
+def _latest_log_event_ms() -> int:
+    """
+    Returns the timestamp of the most recent event in the WAF log group.
+
+    Only the most recently written log stream is fetched, which is far
+    cheaper than running a Logs Insights query.
+
+    Returns:
+        Epoch milliseconds of the latest event, or 0 if the group has none
+    """
+    response: Dict[str, Any] = _logs_client().describe_log_streams(
+        logGroupName=WAF_LOG_GROUP_NAME,
+        orderBy="LastEventTime",
+        descending=True,
+        limit=1,
+    )
+    streams: List[Dict[str, Any]] = response.get("logStreams", [])
+    return streams[0].get("lastEventTimestamp", 0) if streams else 0
+
+
+def _extract_block_count(response: Dict[str, Any]) -> int:
+    """
+    Extracts the block count from a completed Logs Insights query response.
+
+    The results are a list of lists of dicts, and the stats query yields a
+    single row with a single field.
+    Example: [[{'field': 'blockCount', 'value': '123'}]]
+
+    Args:
+        response: A get_query_results response
+
+    Returns:
+        The block count, or 0 if the results are empty or malformed
+        (no rows means no matching records, i.e. nothing was blocked)
+    """
+    try:
+        entry: Dict[str, str] = response["results"][0][0]
+        return int(entry["value"]) if entry["field"] == "blockCount" else 0
+    except (KeyError, IndexError, ValueError, TypeError):
+        return 0
 
-        query_id: str = start_query_response["queryId"]
-        print(f"DEBUG: Query started with ID: {query_id}")
 
-        # Poll for query completion
-        response: Optional[Dict[str, Any]] = None
-        status: str = "Running"
-        poll_count: int = 0
+def _query_waf_logs(start_ts: int, end_ts: int) -> Optional[int]:
+    """
+    Counts WAF blocked requests in a time range with CloudWatch Logs Insights.
 
-        while status in ["Running", "Scheduled"]:
-            time.sleep(1)
-            poll_count += 1
-            response = logs_client.get_query_results(queryId=query_id)
-            status = response["status"]
-            print(f"DEBUG: Poll #{poll_count} - Query status: {status}")
+    Args:
+        start_ts: Start of the time range (epoch seconds)
+        end_ts: End of the time range (epoch seconds)
 
-        print(
-            f"DEBUG: Query completed. Response: {json.dumps(response, indent=2, default=str)}"
+    Returns:
+        The number of blocked requests, or None if the query did not complete
+    """
+    # Nothing logged in (or shortly before) the window means nothing was
+    # blocked, so skip starting an Insights query
+    quiet_before_ms: int = (start_ts - LAST_EVENT_LAG) * 1000
+    latest_event_ms: int = _latest_log_event_ms()
+    if latest_event_ms < quiet_before_ms:
+        logger.debug("No WAF log events since %d, skipping query", latest_event_ms)
+        return 0
+
+    # Start the CloudWatch Logs Insights query
+    start_query_response: Dict[str, Any] = _logs_client().start_query(
+        logGroupName=WAF_LOG_GROUP_NAME,
+        startTime=start_ts,
+        endTime=end_ts,
+        queryString=WAF_QUERY,
+    )
+
+    query_id: str = start_query_response["queryId"]
+    logger.debug("Query started with ID: %s", query_id)
+
+    response: Dict[str, Any] = _await_query(query_id)
+
+    if DEBUG:
+        logger.debug(
+            "Query completed. Response: %s",
+            json.dumps(response, indent=2, default=str),
         )
 
-        # Extract block count from query results
-        block_count: int = 0
-        if response and response["status"] == "Complete" and response["results"]:
-            # The result is a list of lists of dicts
-            # Example: [[{'field': 'blockCount', 'value': '123'}]]
-            result_field: list = response["results"][0]
-            print(f"DEBUG: Result field: {json.dumps(result_field, indent=2)}")
+    if response["status"] != "Complete":
+        logger.debug("Query did not complete. Status: %s", response["status"])
+        return None
 
-            count_entry: Optional[Dict[str, str]] = next(
-                (item for item in result_field if item["field"] == "blockCount"), None
-            )
-            if count_entry:
-                block_count = int(count_entry["value"])
-                print(f"DEBUG: Block count extracted: {block_count}")
-            else:
-                print("DEBUG: 'blockCount' field not found in results")
+    block_count: int = _extract_block_count(response)
+    logger.debug("Block count extracted: %d", block_count)
+
+    return block_count
+
+
+def get_waf_block_count(event: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Counts requests blocked by WAF in the last hour.
+
+    Reads the Web ACL's BlockedRequests CloudWatch metric when
+    WAF_WEB_ACL_METRIC_NAME is set, otherwise falls back to a CloudWatch Logs
+    Insights query over the WAF logs. Results are cached in memory for
+    WAF_CACHE_TTL seconds to avoid repeating the lookup on warm invocations.
+
+    Args:
+        event: The Lambda event object (unused but required for handler compatibility)
+
+    Returns:
+        A dictionary containing the HTTP response with block count data
+
+    Raises:
+        Returns 500 status code if WAF is not configured or the lookup fails
+    """
+    logger.debug(
+        "WAF_WEB_ACL_METRIC_NAME = %s, WAF_LOG_GROUP_NAME = %s",
+        WAF_WEB_ACL_METRIC_NAME,
+        WAF_LOG_GROUP_NAME,
+    )
+
+    # Validate WAF configuration
+    if not WAF_WEB_ACL_METRIC_NAME and not WAF_LOG_GROUP_NAME:
+        logger.error("Neither WAF web ACL metric name nor log group name configured!")
+        return {
+            "statusCode": 500,
+            "headers": CORS_HEADERS,
+            "body": _NOT_CONFIGURED_BODY,
+        }
+
+    # Serve from the in-memory cache while it is still fresh
+    if time.monotonic() < _WAF_CACHE["expires"]:
+        logger.debug("Serving cached block count: %s", _WAF_CACHE["body"])
+        return {
+            "statusCode": 200,
+            "headers": CORS_HEADERS,
+            "body": _WAF_CACHE["body"],
+        }
+
+    # Define time range for query (last hour)
+    end_ts: int = int(time.time())
+    start_ts: int = end_ts - 3600
+
+    logger.debug("Starting WAF lookup from %d to %d", start_ts, end_ts)
+
+    try:
+        block_count: Optional[int]
+        if WAF_WEB_ACL_METRIC_NAME:
+            block_count = _get_blocked_requests_metric(start_ts, end_ts)
         else:
-            print(
-                f"DEBUG: Query did not complete successfully. Status: {response['status'] if response else 'None'}"
-            )
+            block_count = _query_waf_logs(start_ts, end_ts)
 
-        print("=" * 80)
+        body: str = (
+            json.dumps({"blockCount": block_count}) if block_count else _ZERO_BODY
+        )
+
+        # Only cache results from lookups that actually completed
+        if block_count is not None:
+            _WAF_CACHE["body"] = body
+            _WAF_CACHE["expires"] = time.monotonic() + WAF_CACHE_TTL
 
         return {
             "statusCode": 200,
-            "headers": get_cors_headers(),
-            "body": json.dumps({"blockCount": block_count}),
+            "headers": CORS_HEADERS,
+            "body": body,
         }
 
     except Exception as e:
-        print(f"ERROR querying WAF logs: {e}")
-        print("=" * 80)
+        logger.error("Error querying WAF block count: %s", e)
         return {
             "statusCode": 500,
-            "headers": get_cors_headers(),
+            "headers": CORS_HEADERS,
             "body": json.dumps(
-                {"error": "Failed to query WAF logs.", "details": str(e)}
+                {"error": "Failed to query WAF block count.", "details": str(e)}
             ),
         }
 
 
+# Handlers for each supported value of the 'action' query parameter
+_ROUTES: Dict[str, Callable[[Dict[str, Any]], Dict[str, Any]]] = {
+    "location": get_visitor_location,
+    "waf": get_waf_block_count,
+}
+
+
 def lambda_handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     """
     Main Lambda handler that routes requests based on the 'action' query parameter.
@@ -251,32 +511,25 @@ def lambda_handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         GET /default/getVisitorLocation?action=location
         GET /default/getVisitorLocation?action=waf
     """
-    # DEBUG LOGGING: Print entire event
-    print("=" * 80)
-    print("DEBUG: Full Lambda event:")
-    print(json.dumps(event, indent=2, default=str))
-    print("=" * 80)
+    if DEBUG:
+        logger.debug("Full Lambda event: %s", json.dumps(event, indent=2, default=str))
 
     # Extract action parameter from query string
     query_params: Dict[str, str] = event.get("queryStringParameters", {}) or {}
     action: Optional[str] = query_params.get("action")
 
-    print(f"DEBUG: Action requested: {action}")
+    logger.debug("Action requested: %s", action)
 
-    if action == "location":
-        return get_visitor_location(event)
-    elif action == "waf":
-        return get_waf_block_count(event)
-    else:
-        # Return error for missing or invalid action parameter
-        print(f"ERROR: Invalid action '{action}'")
-        return {
-            "statusCode": 400,
-            "headers": get_cors_headers(),
-            "body": json.dumps(
-                {
-                    "error": "Missing or invalid action parameter.",
-                    "validActions": ["location", "waf"],
-                }
-            ),
-        }
+    handler: Optional[Callable[[Dict[str, Any]], Dict[str, Any]]] = (
+        _ROUTES.get(action) if action else None
+    )
+    if handler:
+        return handler(event)
+
+    # Return error for missing or invalid action parameter
+    logger.error("Invalid action '%s'", action)
+    return {
+        "statusCode": 400,
+        "headers": CORS_HEADERS,
+        "body": _BAD_ACTION_BODY,
+    }
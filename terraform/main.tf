@@ -125,7 +125,7 @@ resource "aws_iam_role" "lambda_exec_role" {
 # Create IAM policy for Lambda function permissions
 resource "aws_iam_policy" "lambda_policy" {
   name        = "${var.project_name}-lambda-policy"
-  description = "Policy for Lambda function to access CloudWatch Logs and query WAF logs"
+  description = "Policy for Lambda function to access CloudWatch Logs and read WAF block counts"
 
   policy = jsonencode({
     Version = "2012-10-17",
@@ -147,9 +147,18 @@ resource "aws_iam_policy" "lambda_policy" {
           "logs:StartQuery",
           "logs:GetQueryResults",
           "logs:GetQueryResults",
-          "logs:FilterLogEvents"
+          "logs:FilterLogEvents",
+          "logs:DescribeLogStreams",
+          "logs:StopQuery"
         ],
         Resource = "arn:aws:logs:us-east-1:${data.aws_caller_identity.current.account_id}:log-group:${aws_cloudwatch_log_group.waf_logs.name}:*"
+      },
+      {
+        # Allow Lambda to read the WAF BlockedRequests metric
+        # (GetMetricData does not support resource-level permissions)
+        Effect   = "Allow",
+        Action   = "cloudwatch:GetMetricData",
+        Resource = "*"
       }
     ]
   })
@@ -166,10 +175,12 @@ resource "aws_iam_role_policy_attachment" "lambda_policy_attach" {
 #------------------------------------------------------------------------------
 
 # Package Lambda function code into a ZIP file
+# handler.py is the only module shipped; local bytecode caches are left out
 data "archive_file" "lambda_zip" {
   type        = "zip"
   source_dir  = "${path.module}/lambda"
   output_path = "${path.module}/lambda.zip"
+  excludes    = ["__pycache__", "__pycache__/**"]
 }
 
 # Create Lambda function for API backend
@@ -190,7 +201,9 @@ resource "aws_lambda_function" "api_handler" {
   # Environment variables for Lambda function
   environment {
     variables = {
-      WAF_LOG_GROUP_NAME = aws_cloudwatch_log_group.waf_logs.name
+      # WAF metrics are published under the ACL's metric name, not its name
+      WAF_WEB_ACL_METRIC_NAME = aws_wafv2_web_acl.web_acl.visibility_config[0].metric_name
+      WAF_LOG_GROUP_NAME      = aws_cloudwatch_log_group.waf_logs.name
     }
   }
 